@@ -15,13 +15,22 @@
 
 """A subclass of the ipaddress library that includes comments for ipaddress."""
 
+import bisect
 import collections
 import ipaddress
 import itertools
+import operator
+import re
 from typing import Union
 
 import capirca.utils.iputils as iputils
 
+# Dotted quad with an optional prefix length. Octets with leading zeros and
+# netmask/hostmask notation are left to ipaddress.
+_IPV4_RE = re.compile(r'(0|[1-9][0-9]{0,2})\.(0|[1-9][0-9]{0,2})\.'
+                      r'(0|[1-9][0-9]{0,2})\.(0|[1-9][0-9]{0,2})'
+                      r'(?:/([0-9]{1,2}))?\Z')
+
 
 def IP(ip, comment='', token='', strict=True):
   """Take an ip string and return an object of the correct type.
@@ -41,15 +50,48 @@ def IP(ip, comment='', token='', strict=True):
   if isinstance(ip, ipaddress._BaseNetwork):  # pylint disable=protected-access
     imprecise_ip = ip
   else:
+    if isinstance(ip, str):
+      ipv4_tuple = _ParseIPv4(ip)
+      if ipv4_tuple:
+        return IPv4(ipv4_tuple, comment, token, strict=strict)
+    # The parsed network is passed on below, so the string isn't parsed again.
     imprecise_ip = ipaddress.ip_network(ip, strict=strict)
   if imprecise_ip.version == 4:
-    return IPv4(ip, comment, token, strict=strict)
+    return IPv4(imprecise_ip, comment, token, strict=strict)
   elif imprecise_ip.version == 6:
-    return IPv6(ip, comment, token, strict=strict)
+    return IPv6(imprecise_ip, comment, token, strict=strict)
   raise ValueError('Provided IP string "%s" is not a valid v4 or v6 address'
                    % ip)
 
 
+def _ParseIPv4(ip_string):
+  """Quickly parse a plain dotted quad IPv4 string.
+
+  Args:
+    ip_string: the ip address, with an optional prefix length.
+
+  Returns:
+    A tuple of the ip address as an integer and its prefix length, or None if
+    ip_string isn't in that form and must be parsed by ipaddress instead.
+  """
+  match = _IPV4_RE.match(ip_string)
+  if not match:
+    return None
+  ip_int = 0
+  for octet in match.group(1, 2, 3, 4):
+    octet = int(octet)
+    if octet > 255:
+      return None
+    ip_int = ip_int << 8 | octet
+  prefixlen = match.group(5)
+  if prefixlen is None:
+    return ip_int, 32
+  prefixlen = int(prefixlen)
+  if prefixlen > 32:
+    return None
+  return ip_int, prefixlen
+
+
 # TODO(robankeny) remove once at 3.7
 @staticmethod
 def _is_subnet_of(a, b):  # pylint: disable=invalid-name
@@ -67,6 +109,10 @@ def _is_subnet_of(a, b):  # pylint: disable=invalid-name
 class IPv4(ipaddress.IPv4Network):
   """This subclass allows us to keep text comments related to each object."""
 
+  # Slots keep the added attributes out of each object's instance dict.
+  __slots__ = ('_text', '_comments', 'token', 'parent_token', '_net_int',
+               '_netmask_int', '_bcast_int', '_key', '_hash')
+
   def __init__(self, ip_string, comment='', token='', strict=True):
     self.text = comment
     self.token = token
@@ -76,42 +122,100 @@ class IPv4(ipaddress.IPv4Network):
     # using the BaseNetwork object for recreating the IP network
     if isinstance(ip_string, ipaddress._BaseNetwork):  # pylint disable=protected-access
       ip = (ip_string.network_address._ip, ip_string.prefixlen)  # pylint disable=protected-access # pytype: disable=attribute-error
+    elif isinstance(ip_string, str):
+      ip = _ParseIPv4(ip_string) or ip_string
     else:
       ip = ip_string
     super().__init__(ip, strict)
 
+    # Integer forms of the network are cached since sorting, collapsing and
+    # excluding address lists would otherwise build new address objects on
+    # every access.
+    self._net_int = self.network_address._ip  # pylint disable=protected-access
+    self._netmask_int = self.netmask._ip  # pylint disable=protected-access
+    self._bcast_int = self._net_int | (self._netmask_int ^ self._ALL_ONES)
+    self._key = (self._version, self._net_int, self._netmask_int)
+    # Same value as ipaddress uses, so equal ipaddress objects hash alike.
+    self._hash = hash(self._net_int ^ self._netmask_int)
+
   def subnet_of(self, other):
     """Return True if this network is a subnet of other."""
+    if isinstance(other, (IPv4, IPv6)):
+      # Networks are always aligned, so self is within other if it's at least
+      # as specific and masking it with other's netmask yields other.
+      return (self._version == other._version and
+              self._netmask_int >= other._netmask_int and  # pylint disable=protected-access
+              self._net_int & other._netmask_int == other._net_int)  # pylint disable=protected-access
     if self.version != other.version:
       return False
     return self._is_subnet_of(self, other)
 
   def supernet_of(self, other):
     """Return True if this network is a supernet of other."""
+    if isinstance(other, (IPv4, IPv6)):
+      return (self._version == other._version and
+              other._netmask_int >= self._netmask_int and  # pylint disable=protected-access
+              other._net_int & self._netmask_int == self._net_int)  # pylint disable=protected-access
     if self.version != other.version:
       return False
     return self._is_subnet_of(other, self)
 
+  def __hash__(self):
+    return self._hash
+
+  def __eq__(self, other):
+    if isinstance(other, (IPv4, IPv6)):
+      return self._key == other._key  # pylint disable=protected-access
+    return super().__eq__(other)
+
+  def __lt__(self, other):
+    if isinstance(other, (IPv4, IPv6)):
+      if self._version != other._version:  # pylint disable=protected-access
+        raise TypeError('%s and %s are not of the same version' % (
+            self, other))
+      return self._key < other._key  # pylint disable=protected-access
+    return super().__lt__(other)
+
   def __deepcopy__(self, memo):
-    result = self.__class__(self)
+    # The cached integers are already aligned, so use the tuple constructor.
+    result = self.__class__((self._net_int, self._prefixlen))  # pylint disable=protected-access
+    memo[id(self)] = result
     result.text = self.text
     result.token = self.token
     result.parent_token = self.parent_token
     return result
 
+  @property
+  def text(self):
+    return self._text
+
+  @text.setter
+  def text(self, comment):
+    self._text = comment
+    # Rebuilt from the new text on the next AddComment call.
+    self._comments = None
+
   def AddComment(self, comment=''):
     """Append comment to self.text, comma separated.
 
-    Don't add the comment if it's the same as self.text.
+    Don't add the parts of the comment which are already part of self.text.
 
     Args:
       comment: comment to be added.
     """
-    if self.text:
-      if comment and comment not in self.text:
-        self.text += ', ' + comment
-    else:
+    if not self._text:
       self.text = comment
+      return
+    if not comment:
+      return
+    # A set of the comma separated parts of self.text makes each check O(1)
+    # rather than a substring scan of an ever growing text.
+    if self._comments is None:
+      self._comments = set(self._text.split(', '))
+    for part in comment.split(', '):
+      if part not in self._comments:
+        self._comments.add(part)
+        self._text += ', ' + part
 
   def supernet(self, prefixlen_diff=1):
     """Override ipaddress.IPv4 supernet so we can maintain comments.
@@ -128,14 +232,19 @@ class IPv4(ipaddress.IPv4Network):
       PrefixlenDiffInvalidError: Raised when prefixlen - prefixlen_diff results
         in a negative number.
     """
-    if self.prefixlen == 0:
+    if self._prefixlen == 0:
       return self
-    if self.prefixlen - prefixlen_diff < 0:
+    new_prefixlen = self._prefixlen - prefixlen_diff
+    if not 0 <= new_prefixlen <= self._prefixlen:
       raise PrefixlenDiffInvalidError(
           'current prefixlen is %d, cannot have a prefixlen_diff of %d' % (
               self.prefixlen, prefixlen_diff))
-    ret_addr = IPv4(ipaddress.IPv4Network.supernet(self, prefixlen_diff),
-                    comment=self.text, token=self.token)
+    # Mask the cached network integer directly rather than building an
+    # intermediate ipaddress network to copy from.
+    new_net = self._net_int & (
+        self._ALL_ONES ^ ((1 << (self._max_prefixlen - new_prefixlen)) - 1))
+    ret_addr = IPv4((new_net, new_prefixlen), comment=self.text,
+                    token=self.token)
     return ret_addr
 
   # Backwards compatibility name from v1.
@@ -146,6 +255,10 @@ class IPv4(ipaddress.IPv4Network):
 class IPv6(ipaddress.IPv6Network):
   """This subclass allows us to keep text comments related to each object."""
 
+  # Slots keep the added attributes out of each object's instance dict.
+  __slots__ = ('_text', '_comments', 'token', 'parent_token', '_net_int',
+               '_netmask_int', '_bcast_int', '_key', '_hash')
+
   def __init__(self, ip_string, comment='', token='', strict=True):
     self.text = comment
     self.token = token
@@ -159,20 +272,58 @@ class IPv6(ipaddress.IPv6Network):
       ip = ip_string
     super().__init__(ip, strict)
 
+    # Integer forms of the network are cached since sorting, collapsing and
+    # excluding address lists would otherwise build new address objects on
+    # every access.
+    self._net_int = self.network_address._ip  # pylint disable=protected-access
+    self._netmask_int = self.netmask._ip  # pylint disable=protected-access
+    self._bcast_int = self._net_int | (self._netmask_int ^ self._ALL_ONES)
+    self._key = (self._version, self._net_int, self._netmask_int)
+    # Same value as ipaddress uses, so equal ipaddress objects hash alike.
+    self._hash = hash(self._net_int ^ self._netmask_int)
+
   def subnet_of(self, other):
     """Return True if this network is a subnet of other."""
+    if isinstance(other, (IPv4, IPv6)):
+      # Networks are always aligned, so self is within other if it's at least
+      # as specific and masking it with other's netmask yields other.
+      return (self._version == other._version and
+              self._netmask_int >= other._netmask_int and  # pylint disable=protected-access
+              self._net_int & other._netmask_int == other._net_int)  # pylint disable=protected-access
     if self.version != other.version:
       return False
     return self._is_subnet_of(self, other)
 
   def supernet_of(self, other):
     """Return True if this network is a supernet of other."""
+    if isinstance(other, (IPv4, IPv6)):
+      return (self._version == other._version and
+              other._netmask_int >= self._netmask_int and  # pylint disable=protected-access
+              other._net_int & self._netmask_int == self._net_int)  # pylint disable=protected-access
     if self.version != other.version:
       return False
     return self._is_subnet_of(other, self)
 
+  def __hash__(self):
+    return self._hash
+
+  def __eq__(self, other):
+    if isinstance(other, (IPv4, IPv6)):
+      return self._key == other._key  # pylint disable=protected-access
+    return super().__eq__(other)
+
+  def __lt__(self, other):
+    if isinstance(other, (IPv4, IPv6)):
+      if self._version != other._version:  # pylint disable=protected-access
+        raise TypeError('%s and %s are not of the same version' % (
+            self, other))
+      return self._key < other._key  # pylint disable=protected-access
+    return super().__lt__(other)
+
   def __deepcopy__(self, memo):
-    result = self.__class__(self)
+    # The cached integers are already aligned, so use the tuple constructor.
+    result = self.__class__((self._net_int, self._prefixlen))  # pylint disable=protected-access
+    memo[id(self)] = result
     result.text = self.text
     result.token = self.token
     result.parent_token = self.parent_token
@@ -192,54 +343,157 @@ class IPv6(ipaddress.IPv6Network):
       PrefixlenDiffInvalidError: Raised when prefixlen - prefixlen_diff results
         in a negative number.
     """
-    if self.prefixlen == 0:
+    if self._prefixlen == 0:
       return self
-    if self.prefixlen - prefixlen_diff < 0:
+    new_prefixlen = self._prefixlen - prefixlen_diff
+    if not 0 <= new_prefixlen <= self._prefixlen:
       raise PrefixlenDiffInvalidError(
           'current prefixlen is %d, cannot have a prefixlen_diff of %d' % (
               self.prefixlen, prefixlen_diff))
-    ret_addr = IPv6(ipaddress.IPv6Network.supernet(self, prefixlen_diff),
-                    comment=self.text, token=self.token)
+    # Mask the cached network integer directly rather than building an
+    # intermediate ipaddress network to copy from.
+    new_net = self._net_int & (
+        self._ALL_ONES ^ ((1 << (self._max_prefixlen - new_prefixlen)) - 1))
+    ret_addr = IPv6((new_net, new_prefixlen), comment=self.text,
+                    token=self.token)
     return ret_addr
 
   # Backwards compatibility name from v1.
   Supernet = supernet
   _is_subnet_of = _is_subnet_of
 
+  @property
+  def text(self):
+    return self._text
+
+  @text.setter
+  def text(self, comment):
+    self._text = comment
+    # Rebuilt from the new text on the next AddComment call.
+    self._comments = None
+
   def AddComment(self, comment=''):
     """Append comment to self.text, comma separated.
 
-    Don't add the comment if it's the same as self.text.
+    Don't add the parts of the comment which are already part of self.text.
 
     Args:
       comment: comment to be added.
     """
-    if self.text:
-      if comment and comment not in self.text:
-        self.text += ', ' + comment
-    else:
+    if not self._text:
       self.text = comment
+      return
+    if not comment:
+      return
+    # A set of the comma separated parts of self.text makes each check O(1)
+    # rather than a substring scan of an ever growing text.
+    if self._comments is None:
+      self._comments = set(self._text.split(', '))
+    for part in comment.split(', '):
+      if part not in self._comments:
+        self._comments.add(part)
+        self._text += ', ' + part
 
 
 IPType = Union[IPv4, IPv6]
 
+_SORT_KEY = operator.attrgetter('_key')
+_VERSION_KEY = operator.attrgetter('version')
 
-def _InNetList(adders, ip):
-  """Returns True if ip is contained in adders."""
-  for addr in adders:
-    if ip.subnet_of(addr):
-      return True
-  return False
+# Up to this many distinct prefix lengths _BuildContainmentIndex also indexes
+# nets by prefix length, which is faster to look up than a binary search.
+_MAX_INDEXED_PREFIXLENS = 2
 
+# Netmasks as integers, indexed by prefix length.
+_MASKS_V4 = tuple(
+    ipaddress.IPv4Network._ALL_ONES ^ ((1 << (32 - prefixlen)) - 1)  # pylint disable=protected-access
+    for prefixlen in range(33))
+_MASKS_V6 = tuple(
+    ipaddress.IPv6Network._ALL_ONES ^ ((1 << (128 - prefixlen)) - 1)  # pylint disable=protected-access
+    for prefixlen in range(129))
 
-def IsSuperNet(supernets, subnets):
-  """Returns True if subnets are fully consumed by supernets."""
+
+def _RangeInts(addr):
+  """Return the first and last address of any network as integers."""
+  try:
+    return addr._net_int, addr._bcast_int  # pylint disable=protected-access
+  except AttributeError:
+    return int(addr.network_address), int(addr.broadcast_address)
+
+
+def _BuildContainmentIndex(nets):
+  """Build an index to test if addresses are contained in a list of nets.
+
+  Args:
+    nets: list of IPv4 or IPv6 objects.
+
+  Returns:
+    A dict of IP version to a (starts, ends, nets, prefixes) tuple. starts,
+    ends and nets are sorted by network address, and each entry of ends is the
+    highest broadcast address of nets up to that position. Since netblocks are
+    either nested or disjoint an address is contained in nets if the closest
+    preceding entry of ends covers it.
+    When nets only use a few distinct prefix lengths, prefixes is a list of
+    (prefixlen, host bits, set of network addresses shifted right by the host
+    bits) tuples sorted by prefix length, otherwise it is None.
+  """
+  index = {}
+  for net in SortAddrList(nets):
+    starts, ends, sorted_nets, _ = index.setdefault(
+        net.version, ([], [], [], None))
+    first, last = _RangeInts(net)
+    if ends and ends[-1] > last:
+      ends.append(ends[-1])
+    else:
+      ends.append(last)
+    starts.append(first)
+    sorted_nets.append(net)
+  for version, (starts, ends, sorted_nets, _) in index.items():
+    prefixes = collections.defaultdict(set)
+    for first, net in zip(starts, sorted_nets):
+      host_bits = net.max_prefixlen - net.prefixlen
+      prefixes[net.prefixlen].add(first >> host_bits)
+      if len(prefixes) > _MAX_INDEXED_PREFIXLENS:
+        break
+    else:
+      index[version] = (starts, ends, sorted_nets, [
+          (prefixlen, sorted_nets[0].max_prefixlen - prefixlen, shifted)
+          for prefixlen, shifted in sorted(prefixes.items())])
+  return index
+
+
+def _InNetList(index, ip):
+  """Returns True if ip is contained in a _BuildContainmentIndex index."""
+  if ip.version not in index:
+    return False
+  starts, ends, _, prefixes = index[ip.version]
+  first, last = _RangeInts(ip)
+  if prefixes is not None:
+    # ip is in a net if it's at least as specific and has the same network
+    # bits, which is a set lookup per distinct prefix length.
+    for prefixlen, host_bits, shifted in prefixes:
+      if prefixlen > ip.prefixlen:
+        return False
+      if first >> host_bits in shifted:
+        return True
+    return False
+  idx = bisect.bisect_right(starts, first) - 1
+  return idx >= 0 and ends[idx] >= last
+
+
+def _IsSuperNet(index, subnets):
+  """Returns True if subnets are fully consumed by an indexed list of nets."""
   for net in subnets:
-    if not _InNetList(supernets, net):
+    if not _InNetList(index, net):
       return False
   return True
 
 
+def IsSuperNet(supernets, subnets):
+  """Returns True if subnets are fully consumed by supernets."""
+  return _IsSuperNet(_BuildContainmentIndex(supernets), subnets)
+
+
 def CollapseAddrListPreserveTokens(addresses):
   """Collapse an array of IPs only when their tokens are the same.
 
@@ -249,50 +503,119 @@ def CollapseAddrListPreserveTokens(addresses):
   Returns:
     list of ipaddress.IPNetwork objects.
   """
+  # Group in a single pass, only the distinct tokens need sorting to keep the
+  # output ordered by token.
+  groups = collections.defaultdict(list)
+  for addr in addresses:
+    groups[addr.parent_token].append(addr)
   ret_array = []
-  for grp in itertools.groupby(sorted(addresses, key=lambda x: x.parent_token),
-                               lambda x: x.parent_token):
-    ret_array.append(CollapseAddrList(list(grp[1])))
+  for parent_token in sorted(groups):
+    ret_array.append(CollapseAddrList(groups[parent_token]))
+  # Containment indexes are built once per group and kept alongside it.
   dedup_array = []
-  i = 0
-  while len(ret_array) > i:
-    ip = ret_array.pop(0)
+  dedup_indexes = []
+  for ip in ret_array:
+    ip_index = _BuildContainmentIndex(ip)
     k = 0
     to_add = True
     while k < len(dedup_array):
-      if IsSuperNet(dedup_array[k], ip):
+      if _IsSuperNet(dedup_indexes[k], ip):
         to_add = False
         break
-      elif IsSuperNet(ip, dedup_array[k]):
+      elif _IsSuperNet(ip_index, dedup_array[k]):
         del dedup_array[k]
+        del dedup_indexes[k]
       k += 1
     if to_add:
       dedup_array.append(ip)
+      dedup_indexes.append(ip_index)
   return [i for sublist in dedup_array for i in sublist]
 
 
-def _SafeToMerge(address, merge_target, check_addresses):
-  """Determine if it's safe to merge address into merge target.
+def _SafeToMerge(prefixlen, merge_prefixlen, check_prefixlens):
+  """Determine if it's safe to merge an address into merge target.
 
-  Checks given address against merge target and a list of check_addresses
-  if it's OK to roll address into merge target such that it not less specific
-  than any of the check_addresses. See description of why ir is important
-  within public function CollapseAddrList.
+  Checks the prefix length of the address being merged and of the merge target
+  against the prefix lengths of check addresses if it's OK to roll address into
+  merge target such that it not less specific than any of the check addresses.
+  See description of why ir is important within public function
+  CollapseAddrList.
 
   Args:
-    address: Address that is being merged.
-    merge_target: Merge candidate address.
-    check_addresses: A dict networks_address->addrs to compare specificity with.
+    prefixlen: Prefix length of the address that is being merged.
+    merge_prefixlen: Prefix length of the merge candidate address.
+    check_prefixlens: Prefix lengths of the addrs sharing the network address of
+      the address being merged to compare specificity with.
 
   Returns:
     True if safe to merge, False otherwise.
   """
-  for check_address in check_addresses.get(address.network_address, []):
-    if merge_target.netmask <= check_address.netmask < address.netmask:
+  for check_prefixlen in check_prefixlens:
+    if merge_prefixlen <= check_prefixlen < prefixlen:
       return False
   return True
 
 
+def _CollapseKernel(starts, prefixlens, masks, checks):
+  """Collapses sorted netblocks of a single IP version given as integers.
+
+  This is a plain stack over the integer forms of the netblocks, no network
+  objects are involved. Netmasks come from a precomputed table, so both the
+  subsumption and the merge test are a single masked comparison.
+
+  Args:
+    starts: Sorted list of network addresses as integers.
+    prefixlens: List of prefix lengths of the netblocks in starts.
+    masks: Netmasks of this IP version as integers, indexed by prefix length.
+    checks: List holding, for each netblock in starts, the prefix lengths of
+      complement addresses sharing its network address or None, see
+      _SafeToMerge. Empty if there are no complement addresses at all.
+
+  Returns:
+    Tuple of (starts, prefixlens, heads) lists for the surviving netblocks.
+    Every netblock only ever merges with the top of the stack, so each
+    survivor consumed a contiguous run of the input: heads holds the index of
+    the first input netblock of the run, which ends before the next head.
+  """
+  stack_starts = []
+  stack_prefixlens = []
+  stack_heads = []
+  for i, start in enumerate(starts):
+    prefixlen = prefixlens[i]
+    head = i
+    while stack_starts:
+      prev_start = stack_starts[-1]
+      prev_prefixlen = stack_prefixlens[-1]
+      # Nearly all calls have no complements to check at all.
+      if (checks and checks[head] and
+          not _SafeToMerge(prefixlen, prev_prefixlen, checks[head])):
+        break
+      if (prefixlen >= prev_prefixlen and
+          start & masks[prev_prefixlen] == prev_start):
+        # The netblock joins the run of the top of the stack, which preserves
+        # its comment.
+        head = None
+        break
+      # Two /0s are handled above, so prefixlen is at least 1 here. Distinct
+      # netblocks of the same size sharing a supernet are its two halves.
+      if (prev_prefixlen == prefixlen and start != prev_start and
+          start & masks[prefixlen - 1] == prev_start):
+        # Preserve the comment, merge with it and retry against the new top
+        # of the stack.
+        stack_starts.pop()
+        stack_prefixlens.pop()
+        head = stack_heads.pop()
+        start = prev_start
+        prefixlen -= 1
+        continue
+      break
+    if head is not None:
+      stack_starts.append(start)
+      stack_prefixlens.append(prefixlen)
+      stack_heads.append(head)
+  return stack_starts, stack_prefixlens, stack_heads
+
+
 def _CollapseAddrListInternal(addresses, complements_by_network):
   """Collapses consecutive netblocks until reaching a fixed point.
 
@@ -312,44 +635,44 @@ def _CollapseAddrListInternal(addresses, complements_by_network):
    CollapseAddrList([])
 
   Args:
-    addresses: List of IPv4 or IPv6 objects
-    complements_by_network: Dict of IPv4 or IPv6 objects indexed by
-      network_address, that if present will be considered to avoid harmful
-      optimizations.
+    addresses: Sorted list of IPv4 or IPv6 objects
+    complements_by_network: Dict of prefix lengths of IPv4 or IPv6 objects
+      indexed by (version, network address as integer), that if present will
+      be considered to avoid harmful optimizations.
 
   Returns:
     List of IPv4 or IPv6 objects (depending on what we were passed)
   """
+  # The collapse itself runs over parallel lists of integers, which is much
+  # faster than generating a Supernet object for every merge. New objects are
+  # only built for the netblocks that survive. Each surviving netblock knows
+  # the run of addresses it consumed, so their comments can be merged.
   ret_array = []
-  for addr in addresses:
-    addr_is_fresh = True
-    while addr_is_fresh:
-      addr_is_fresh = False
-      if not ret_array:
-        ret_array.append(addr)
-        continue
-
-      prev_addr = ret_array[-1]
-      if not _SafeToMerge(addr, prev_addr, complements_by_network):
-        ret_array.append(addr)
-      elif prev_addr.supernet_of(addr):
-        # Preserve addr's comment, then subsume it.
-        prev_addr.AddComment(addr.text)
-      elif (prev_addr.version == addr.version and
-            prev_addr.prefixlen == addr.prefixlen and
-            # It's faster to compare integers than IP objects
-            prev_addr.broadcast_address._ip + 1 == addr.network_address._ip and  # pylint disable=protected-access
-            # Generating Supernet is relatively intensive compared to doing bit
-            # operations
-            (prev_addr.netmask._ip << 1) & prev_addr.network_address._ip ==      # pylint disable=protected-access
-            prev_addr.network_address._ip):                                      # pylint disable=protected-access
-        # Preserve addr's comment, then merge with it.
-        prev_addr.AddComment(addr.text)
-        addr = ret_array.pop().Supernet()
-        addr_is_fresh = True
-      else:
-        ret_array.append(addr)
-
+  for _, group in itertools.groupby(addresses, _VERSION_KEY):
+    group = list(group)
+    try:
+      starts = [addr._net_int for addr in group]  # pylint disable=protected-access
+    except AttributeError:
+      starts = [_RangeInts(addr)[0] for addr in group]
+    prefixlens = [addr.prefixlen for addr in group]
+    if complements_by_network:
+      version = group[0].version
+      checks = [complements_by_network.get((version, start))
+                for start in starts]
+    else:
+      checks = ()
+    masks = _MASKS_V4 if group[0].version == 4 else _MASKS_V6
+    stack_starts, stack_prefixlens, stack_heads = _CollapseKernel(
+        starts, prefixlens, masks, checks)
+    stack_heads.append(len(group))
+    for i, head in enumerate(stack_heads[:-1]):
+      addr = group[head]
+      if stack_prefixlens[i] != addr.prefixlen:
+        addr = addr.__class__((stack_starts[i], stack_prefixlens[i]),
+                              comment=addr.text, token=addr.token)
+      for member in range(head + 1, stack_heads[i + 1]):
+        addr.AddComment(group[member].text)
+      ret_array.append(addr)
   return ret_array
 
 
@@ -374,23 +697,74 @@ def CollapseAddrList(addresses, complement_addresses=None):
   Args:
      addresses: list of ipaddress.IPNetwork objects
      complement_addresses: list of ipaddress.IPNetwork objects that, if present,
-      will be considered to avoid harmful optimizations.
+      will be considered to avoid harmful optimizations. Only their network
+      address and prefix length are used.
 
   Returns:
     list of ipaddress.IPNetwork objects
   """
   complements_dict = collections.defaultdict(list)
-  address_set = set([a.network_address for a in addresses])
-  for ca in complement_addresses or []:
-    if ca.network_address in address_set:
-      complements_dict[ca.network_address].append(ca)
-  return _CollapseAddrListInternal(
-      sorted(addresses, key=ipaddress.get_mixed_type_key), complements_dict)
+  if complement_addresses:
+    # Keyed on the version too, 0.0.0.0 and :: share the same integer.
+    address_set = set((a.version, _RangeInts(a)[0]) for a in addresses)
+    for ca in complement_addresses:
+      network = (ca.version, _RangeInts(ca)[0])
+      if network in address_set:
+        complements_dict[network].append(ca.prefixlen)
+  return _CollapseAddrListInternal(SortAddrList(addresses), complements_dict)
 
 
 def SortAddrList(addresses):
   """Return a sorted list of nacaddr objects."""
-  return sorted(addresses, key=ipaddress.get_mixed_type_key)
+  # Sorting on the cached integer keys avoids building and comparing address
+  # objects for every element.
+  try:
+    return sorted(addresses, key=_SORT_KEY)
+  except AttributeError:
+    return sorted(addresses, key=ipaddress.get_mixed_type_key)
+
+
+def _FromInt(net_int, prefixlen, template):
+  """Return a nacaddr object with the comment and tokens of template.
+
+  Args:
+    net_int: the network address as an integer.
+    prefixlen: the prefix length of the network.
+    template: the nacaddr or ipaddress network this network was split from.
+
+  Returns:
+    a nacaddr IPv4 or IPv6 address
+  """
+  # The version is known, so skip the dispatch in IP() and use the
+  # integer/prefixlength tuple constructor.
+  addr_class = IPv4 if template.version == 4 else IPv6
+  ret_addr = addr_class((net_int, prefixlen),
+                        comment=getattr(template, 'text', ''),
+                        token=getattr(template, 'token', ''))
+  ret_addr.parent_token = getattr(template, 'parent_token', ret_addr.token)
+  return ret_addr
+
+
+def _SummarizeRange(first, last, bits):
+  """Split an integer address range into the fewest netblocks.
+
+  Integer equivalent of ipaddress.summarize_address_range.
+
+  Args:
+    first: the first address of the range as an integer.
+    last: the last address of the range as an integer.
+    bits: number of bits in an address of this IP version.
+
+  Yields:
+    (network address, prefix length) tuples covering the range in order.
+  """
+  while first <= last:
+    # Largest netblock which is aligned on first and doesn't exceed last.
+    host_bits = (last - first + 1).bit_length() - 1
+    if first:
+      host_bits = min(host_bits, (first & -first).bit_length() - 1)
+    yield first, bits - host_bits
+    first += 1 << host_bits
 
 
 def RemoveAddressFromList(superset, exclude):
@@ -410,7 +784,9 @@ def RemoveAddressFromList(superset, exclude):
     elif exclude.version == addr.version and exclude.subnet_of(addr):
       # this could be optimized except that one group uses this
       # code with ipaddrs (instead of nacaddrs).
-      ret_array.extend(IP(x) for x in iputils.exclude_address(addr, exclude))
+      ret_array.extend(
+          _FromInt(x.network_address._ip, x.prefixlen, addr)  # pylint disable=protected-access
+          for x in iputils.exclude_address(addr, exclude))
     else:
       ret_array.append(addr)
   return SortAddrList(ret_array)
@@ -428,26 +804,56 @@ def AddressListExclude(superset, excludes, collapse_addrs=True):
     a List of nacaddr IPv4 or IPv6 addresses
   """
   if collapse_addrs:
-    superset = CollapseAddrList(superset)[::-1]
-    excludes = CollapseAddrList(excludes)[::-1]
+    superset = CollapseAddrList(superset)
+    excludes = CollapseAddrList(excludes)
   else:
-    superset = sorted(superset, reverse=True)
-    excludes = sorted(excludes, reverse=True)
-
+    superset = SortAddrList(superset)
+    excludes = SortAddrList(excludes)
+
+  # The excludes are kept as parallel lists of first and last addresses per
+  # IP version, sorted by first address.
+  exclude_ranges = {}
+  for exclude in excludes:
+    firsts, lasts = exclude_ranges.setdefault(exclude.version, ([], []))
+    first, last = _RangeInts(exclude)
+    firsts.append(first)
+    lasts.append(last)
+
+  # A single sweep over the superset subtracts the overlapping excludes from
+  # each address as an integer range. Only the remaining gaps are split back
+  # into netblocks, addresses that don't overlap any exclude are kept as is.
   ret_array = []
-  while superset and excludes:
-    if superset[-1].overlaps(excludes[-1]):
-      ip = superset.pop()
-      superset.extend(
-          reversed(RemoveAddressFromList([ip], excludes[-1])))
-    elif superset[-1]._get_networks_key() < excludes[-1]._get_networks_key():  # pylint: disable=protected-access
-      ret_array.append(superset.pop())
-    else:
-      excludes.pop()
+  version = None
+  for ip in superset:
+    if ip.version != version:
+      version = ip.version
+      firsts, lasts = exclude_ranges.get(version, ((), ()))
+      ei = 0
+    first, last = _RangeInts(ip)
+    # Excludes below ip can't overlap it or any of the addresses after it.
+    while ei < len(firsts) and lasts[ei] < first:
+      ei += 1
+    k = ei
+    pos = first
+    gaps = []
+    while k < len(firsts) and firsts[k] <= last:
+      if firsts[k] > pos:
+        gaps.append((pos, firsts[k] - 1))
+      pos = max(pos, lasts[k] + 1)
+      k += 1
+    if k == ei:
+      ret_array.append(ip)
+      continue
+    if pos <= last:
+      gaps.append((pos, last))
+    for gap_first, gap_last in gaps:
+      for net_int, prefixlen in _SummarizeRange(gap_first, gap_last,
+                                                ip.max_prefixlen):
+        ret_array.append(_FromInt(net_int, prefixlen, ip))
   if collapse_addrs:
-    return CollapseAddrList(ret_array + superset)
+    return CollapseAddrList(ret_array)
   else:
-    return sorted(set(ret_array + superset))
+    return sorted(set(ret_array))
 
 
 ExcludeAddrs = AddressListExclude
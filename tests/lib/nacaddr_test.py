@@ -14,6 +14,9 @@
 
 """Unittest for nacaddr.py module."""
 
+import copy
+import ipaddress
+
 from absl.testing import absltest
 
 from capirca.lib import nacaddr
@@ -59,6 +62,14 @@ class NacaddrUnitTest(absltest.TestCase):
     self.assertEqual(collapsed[0].text, 'foo')
     self.assertListEqual(collapsed, [nacaddr.IPv4(u'1.1.0.0/23')])
 
+    # test that comments are merged per consumed address, in input order,
+    # without repeating a comment already carried by the merged netblock
+    collapsed = nacaddr.CollapseAddrList(
+        [nacaddr.IPv4(u'10.0.0.%d/32' % i, comment)
+         for i, comment in enumerate(['a', 'a', 'a', 'b'])])
+    self.assertListEqual(collapsed, [nacaddr.IPv4(u'10.0.0.0/30')])
+    self.assertEqual(collapsed[0].text, 'a, b')
+
     ip_same1 = ip_same2 = nacaddr.IPv4(u'1.1.1.1/32')
     self.assertListEqual(nacaddr.CollapseAddrList([ip_same1, ip_same2]),
                          [ip_same1])
@@ -75,6 +86,72 @@ class NacaddrUnitTest(absltest.TestCase):
   def testNacaddrV6Comment(self):
     self.assertEqual(self.addr2.text, 'An IPv6 Address')
 
+  def testHashAndOrdering(self):
+    addr = nacaddr.IPv4('10.0.0.0/8', 'other comment')
+    plain = ipaddress.IPv4Network('10.0.0.0/8')
+    self.assertEqual(addr, self.addr1)
+    self.assertEqual(addr, plain)
+    self.assertEqual(hash(addr), hash(plain))
+    self.assertLen({addr, self.addr1, plain}, 1)
+    self.assertNotEqual(addr, nacaddr.IPv4('10.0.0.0/9'))
+    self.assertLess(addr, nacaddr.IPv4('10.0.0.0/9'))
+    self.assertLess(addr, nacaddr.IPv4('11.0.0.0/8'))
+    self.assertRaises(TypeError, lambda: addr < self.addr2)
+
+  def testSortAddrList(self):
+    self.assertListEqual(
+        nacaddr.SortAddrList([self.addr2, nacaddr.IPv4('10.0.0.0/9'),
+                              self.addr1]),
+        [self.addr1, nacaddr.IPv4('10.0.0.0/9'), self.addr2])
+    # Anything ipaddress.get_mixed_type_key accepts sorts the same way.
+    plain = [ipaddress.ip_network('10.0.0.0/9'), self.addr2,
+             ipaddress.ip_network('10.0.0.0/8')]
+    self.assertListEqual(nacaddr.SortAddrList(plain),
+                         sorted(plain, key=ipaddress.get_mixed_type_key))
+    self.assertListEqual(
+        nacaddr.SortAddrList([ipaddress.ip_address('10.0.0.1'),
+                              ipaddress.ip_address('1.0.0.1')]),
+        [ipaddress.ip_address('1.0.0.1'), ipaddress.ip_address('10.0.0.1')])
+
+  def testDeepCopy(self):
+    addr = nacaddr.IPv6('10::/64', 'v6 comment', token='FOO')
+    addr.parent_token = 'BAR'
+    for orig in (self.addr1, addr):
+      dup = copy.deepcopy(orig)
+      self.assertIsNot(dup, orig)
+      self.assertIsInstance(dup, type(orig))
+      self.assertEqual(dup, orig)
+      self.assertEqual(dup.text, orig.text)
+      self.assertEqual(dup.token, orig.token)
+      self.assertEqual(dup.parent_token, orig.parent_token)
+
+  def testIPParsing(self):
+    self.assertEqual(nacaddr.IP('10.1.1.0/24'), nacaddr.IPv4('10.1.1.0/24'))
+    self.assertEqual(nacaddr.IP('10.1.1.1').prefixlen, 32)
+    self.assertEqual(nacaddr.IP('10.1.1.1/24', strict=False),
+                     nacaddr.IPv4('10.1.1.0/24'))
+    self.assertEqual(nacaddr.IP('10.1.1.0/255.255.255.0'),
+                     nacaddr.IPv4('10.1.1.0/24'))
+    self.assertEqual(nacaddr.IP('::1').version, 6)
+    for bad_ip in ('10.1.1.1/24', '10.1.1.256', '10.1.1.0/33', '10.1.1.0/'):
+      self.assertRaises(ValueError, nacaddr.IP, bad_ip)
+
+  def testAddComment(self):
+    addr = nacaddr.IPv4('10.0.0.0/8')
+    addr.AddComment('foo')
+    self.assertEqual(addr.text, 'foo')
+    addr.AddComment('foo')
+    addr.AddComment('')
+    self.assertEqual(addr.text, 'foo')
+    addr.AddComment('foo, bar')
+    addr.AddComment('foobar')
+    self.assertEqual(addr.text, 'foo, bar, foobar')
+    addr.text = 'baz'
+    addr.AddComment('foo')
+    self.assertEqual(addr.text, 'baz, foo')
+    self.addr2.AddComment('An IPv6 Address')
+    self.assertEqual(self.addr2.text, 'An IPv6 Address')
+
   def testSupernetting(self):
     self.assertEqual(self.addr1.Supernet().text, 'The 10 block')
     self.assertEqual(self.addr2.Supernet().text, 'An IPv6 Address')
@@ -116,6 +193,17 @@ class NacaddrUnitTest(absltest.TestCase):
     self.assertListEqual(nacaddr.AddressListExclude([a1, a2], [b1, b2, b3]),
                          sorted(expected_two))
 
+  def testRemoveAddressFromListKeepsComments(self):
+    superset = [nacaddr.IPv4('10.0.0.0/30', 'foo comment', token='FOO')]
+    exclude = nacaddr.IPv4('10.0.0.1/32')
+    remaining = nacaddr.RemoveAddressFromList(superset, exclude)
+    self.assertListEqual(remaining, [nacaddr.IPv4('10.0.0.0/32'),
+                                     nacaddr.IPv4('10.0.0.2/31')])
+    for addr in remaining:
+      self.assertIsInstance(addr, nacaddr.IPv4)
+      self.assertEqual(addr.text, 'foo comment')
+      self.assertEqual(addr.token, 'FOO')
+
   def testComplexAddressListExcludesion(self):
     # this is a big fugly test. there was a bug in AddressListExclude
     # which manifested itself when more than one member of the excludes
@@ -212,6 +300,51 @@ class NacaddrUnitTest(absltest.TestCase):
     self.assertListEqual(nacaddr.AddressListExclude(superset, excludes),
                          expected)
 
+  def testAddressListExcludeNestedSuperset(self):
+    # Without collapsing, an exclude must also be removed from superset
+    # addresses nested inside an address it already split.
+    superset = [nacaddr.IPv4('10.0.0.0/8'), nacaddr.IPv4('10.0.0.0/16')]
+    excludes = [nacaddr.IPv4('10.0.5.0/24')]
+    expected = [nacaddr.IPv4('10.0.0.0/22'), nacaddr.IPv4('10.0.4.0/24'),
+                nacaddr.IPv4('10.0.6.0/23'), nacaddr.IPv4('10.0.8.0/21'),
+                nacaddr.IPv4('10.0.16.0/20'), nacaddr.IPv4('10.0.32.0/19'),
+                nacaddr.IPv4('10.0.64.0/18'), nacaddr.IPv4('10.0.128.0/17'),
+                nacaddr.IPv4('10.1.0.0/16'), nacaddr.IPv4('10.2.0.0/15'),
+                nacaddr.IPv4('10.4.0.0/14'), nacaddr.IPv4('10.8.0.0/13'),
+                nacaddr.IPv4('10.16.0.0/12'), nacaddr.IPv4('10.32.0.0/11'),
+                nacaddr.IPv4('10.64.0.0/10'), nacaddr.IPv4('10.128.0.0/9')]
+    self.assertListEqual(
+        nacaddr.AddressListExclude(superset, excludes, collapse_addrs=False),
+        expected)
+
+  def testAddressListExcludePlainNetworks(self):
+    # Without collapsing, plain ipaddress objects are supported as well.
+    superset = [ipaddress.IPv4Network('10.0.0.0/8'),
+                ipaddress.IPv4Network('192.168.0.0/24')]
+    excludes = [ipaddress.IPv4Network('10.1.0.0/16')]
+    expected = list(superset[0].address_exclude(excludes[0])) + superset[1:]
+    self.assertListEqual(
+        nacaddr.AddressListExclude(superset, excludes, collapse_addrs=False),
+        sorted(expected))
+    self.assertListEqual(
+        nacaddr.AddressListExclude([nacaddr.IPv4('10.0.0.0/8')], excludes,
+                                   collapse_addrs=False),
+        sorted(expected[:-1]))
+
+  def testCollapsePlainNetworks(self):
+    # Plain ipaddress objects that do not need merging pass straight through.
+    plain = [ipaddress.ip_network('192.168.0.0/16'),
+             ipaddress.ip_network('10.0.0.0/8')]
+    self.assertListEqual(nacaddr.CollapseAddrList(plain),
+                         sorted(plain))
+    excludes = [ipaddress.ip_network('10.0.0.0/9')]
+    expected = [ipaddress.ip_network('10.128.0.0/9'),
+                ipaddress.ip_network('192.168.0.0/16')]
+    self.assertListEqual(nacaddr.AddressListExclude(plain, excludes), expected)
+    self.assertListEqual(
+        nacaddr.AddressListExclude(plain, excludes, collapse_addrs=False),
+        expected)
+
   def testCollapseAddrListPreserveTokens(self):
     addr_list = [nacaddr.IPv4('10.0.1.7/32', token='BIZ'),
                  nacaddr.IPv4('192.168.1.10/32', token='ALSOUNDERSUPER'),
@@ -246,6 +379,37 @@ class NacaddrUnitTest(absltest.TestCase):
     self.assertFalse(nacaddr.IsSuperNet(addrs2, addrs4))
     self.assertFalse(nacaddr.IsSuperNet(addrs2, addrs5))
     self.assertTrue(nacaddr.IsSuperNet(addrs5, addrs2))
+    # A nested supernet must not hide the netblock that encloses it.
+    addrs6 = [nacaddr.IPv4('10.0.0.0/8'), nacaddr.IPv4('10.0.1.0/24')]
+    addrs7 = [nacaddr.IPv4('10.0.2.0/24'), nacaddr.IPv6('::1/128')]
+    self.assertTrue(nacaddr.IsSuperNet(addrs6, addrs7[:1]))
+    self.assertFalse(nacaddr.IsSuperNet(addrs6, addrs7))
+    # Less specific than every supernet.
+    self.assertFalse(nacaddr.IsSuperNet(addrs2, [nacaddr.IPv4('10.0.0.0/16')]))
+    # Plain ipaddress objects are still supported, also mixed with nacaddr.
+    plain8 = ipaddress.IPv4Network('10.0.0.0/8')
+    plain16 = ipaddress.IPv4Network('10.1.0.0/16')
+    self.assertTrue(nacaddr.IsSuperNet([plain8], [plain16]))
+    self.assertFalse(nacaddr.IsSuperNet([plain16], [plain8]))
+    self.assertTrue(nacaddr.IsSuperNet(addrs6, [plain16]))
+    self.assertTrue(nacaddr.IsSuperNet([plain8], addrs6))
+    # Enough prefix lengths to use the binary search.
+    plain24 = ipaddress.IPv4Network('10.2.0.0/24')
+    self.assertTrue(nacaddr.IsSuperNet([plain8, plain16, plain24], [plain16]))
+    self.assertFalse(nacaddr.IsSuperNet([plain16, plain24], [plain8]))
+    self.assertFalse(nacaddr.IsSuperNet(
+        [plain16, plain24, nacaddr.IPv4('10.3.0.0/20')], [plain8]))
+
+  def testSubnetOf(self):
+    addr = nacaddr.IPv4('10.1.0.0/16')
+    self.assertTrue(addr.subnet_of(self.addr1))
+    self.assertTrue(self.addr1.supernet_of(addr))
+    self.assertFalse(self.addr1.subnet_of(addr))
+    self.assertFalse(addr.supernet_of(self.addr1))
+    self.assertFalse(addr.subnet_of(self.addr2))
+    # Plain ipaddress objects are still supported.
+    self.assertTrue(addr.subnet_of(ipaddress.IPv4Network('10.0.0.0/8')))
+    self.assertFalse(addr.supernet_of(ipaddress.IPv4Network('10.0.0.0/8')))
 
   def testSafeCollapsing(self):
     test_data = [([nacaddr.IPv4('10.0.0.0/8'),
@@ -268,7 +432,17 @@ class NacaddrUnitTest(absltest.TestCase):
                  ([nacaddr.IPv6('10::/128'),
                    nacaddr.IPv6('10::/56')],
                   [nacaddr.IPv6('8::/64')],
-                  [nacaddr.IPv6('10::/56')])
+                  [nacaddr.IPv6('10::/56')]),
+
+                 ([nacaddr.IPv4('10.0.0.0/8')],
+                  [ipaddress.ip_network('10.0.0.0/9')],
+                  [nacaddr.IPv4('10.0.0.0/8')]),
+
+                 ([nacaddr.IPv4('10.0.0.0/8'),
+                   nacaddr.IPv4('10.0.0.0/10')],
+                  [ipaddress.ip_network('10.0.0.0/9')],
+                  [nacaddr.IPv4('10.0.0.0/8'),
+                   nacaddr.IPv4('10.0.0.0/10')])
                  ]
     for addresses, complement_addresses, result in test_data:
       self.assertEqual(nacaddr.CollapseAddrList(addresses,